@@ -32,6 +32,7 @@ from common import user_routes
 from common import users
 from common import utils as common_utils
 from controllers import sites
+from controllers import utils
 from models import courses
 from models import data_sources
 from models import jobs
@@ -46,6 +47,7 @@ from modules.student_groups import student_groups
 from tests.functional import actions
 from tools.etl import etl
 
+from google.appengine.api import memcache
 from google.appengine.api import namespace_manager
 from google.appengine.ext import db
 
@@ -550,6 +552,56 @@ class ClusteringTabTests(actions.TestBase):
             'http://localhost/%s/dashboard?action=analytics_clustering' %
             self.COURSE_NAME, response.location)
 
+    def _get_aggregate_message(self):
+        template_values = {}
+        clustering.TentpoleStudentVectorDataSource.fill_values(
+            self.context, template_values, None)
+        return template_values['message']
+
+    def _set_aggregate_updated_on(self, updated_on):
+        job = student_aggregate.StudentAggregateGenerator(self.context).load()
+        job.updated_on = updated_on
+        job.put()
+        # Treat as module-protected. pylint: disable=protected-access
+        return clustering._AGGREGATE_UPDATED_MESSAGE.format(
+            updated_on.strftime(utils.HUMAN_READABLE_DATETIME_FORMAT))
+
+    def test_aggregate_updated_on_message(self):
+        """The last StudentAggregateGenerator run is read from memcache.
+
+        A job that never ran is not cached, so the first run is shown at
+        once. Later runs are shown when the cached time expires.
+        """
+        # Treat as module-protected. pylint: disable=protected-access
+        with actions.OverriddenConfig(models.CAN_USE_MEMCACHE.name, True):
+            self.assertEqual(clustering._AGGREGATE_NEVER_RUN_MESSAGE,
+                             self._get_aggregate_message())
+
+            student_aggregate.StudentAggregateGenerator(self.context).submit()
+            first_run = self._set_aggregate_updated_on(
+                datetime.datetime(2015, 1, 1, 10, 30))
+            self.assertEqual(first_run, self._get_aggregate_message())
+
+            # Cache hit, the new run is not shown yet.
+            second_run = self._set_aggregate_updated_on(
+                datetime.datetime(2015, 1, 2, 11, 45))
+            self.assertEqual(first_run, self._get_aggregate_message())
+
+            # Simulate the expiration of the cached value.
+            memcache.flush_all()
+            self.assertEqual(second_run, self._get_aggregate_message())
+
+    def test_aggregate_updated_on_message_without_memcache(self):
+        """Without memcache every render shows the last run."""
+        # Treat as module-protected. pylint: disable=protected-access
+        self.assertEqual(clustering._AGGREGATE_NEVER_RUN_MESSAGE,
+                         self._get_aggregate_message())
+        student_aggregate.StudentAggregateGenerator(self.context).submit()
+        for updated_on in [datetime.datetime(2015, 1, 1, 10, 30),
+                           datetime.datetime(2015, 1, 2, 11, 45)]:
+            message = self._set_aggregate_updated_on(updated_on)
+            self.assertEqual(message, self._get_aggregate_message())
+
 class ClusterRESTHandlerTest(actions.TestBase):
     """Tests for the add_cluster handler and page."""
 
@@ -857,6 +909,35 @@ class ClusterRESTHandlerTest(actions.TestBase):
                                   clustering.DIM_TYPE_QUESTION)
         self.assertIsNotNone(dim)
 
+    def test_possible_dimensions_cached(self):
+        """Dimensions are cached for the cluster editor, but not for the job.
+
+        A unit added after the dimensions are cached is not listed until the
+        cache expires, while StudentVectorGenerator sees it immediately.
+        """
+        with actions.OverriddenConfig(models.CAN_USE_MEMCACHE.name, True):
+            vector = clustering.get_possible_dimensions(self.app_context)
+            self._add_unit(self.units_number + 10)
+            self.course.save()
+            unit_id = self.unit_keys[-1][1]
+
+            # Cache hit, the new unit is not listed yet.
+            self.assertEqual(
+                vector, clustering.get_possible_dimensions(self.app_context))
+            self.assertFalse([dim for dim in vector
+                              if dim[clustering.DIM_ID] == unit_id])
+
+            job = clustering.StudentVectorGenerator(self.app_context)
+            params = job.build_additional_mapper_params(self.app_context)
+            self._dim_from_dict(params['possible_dimensions'], unit_id,
+                                clustering.DIM_TYPE_UNIT_VISIT)
+
+            # Simulate the expiration of the cached value.
+            memcache.flush_all()
+            vector = clustering.get_possible_dimensions(self.app_context)
+            self._dim_from_dict(vector, unit_id,
+                                clustering.DIM_TYPE_UNIT_VISIT)
+
     def test_save_name(self):
         """Save cluster with correct name."""
         # get a sample payload
@@ -1077,6 +1158,18 @@ class ClusterRESTHandlerTest(actions.TestBase):
 
         self.assertIn('"status": 412', response.body)
 
+    def test_coerce_range_value(self):
+        """Range values are converted to float, empty values to None."""
+        # Treat as module-protected. pylint: disable=protected-access
+        coerce = clustering._coerce_range_value
+        self.assertEqual(coerce(None), (True, None))
+        self.assertEqual(coerce(''), (True, None))
+        self.assertEqual(coerce('1e5'), (True, 100000.0))
+        self.assertEqual(coerce('-0.5'), (True, -0.5))
+        self.assertEqual(coerce(3), (True, 3.0))
+        self.assertEqual(coerce(2.5), (True, 2.5))
+        self.assertEqual(coerce('abc'), (False, None))
+
     def test_save_correct_url(self):
         """Test if the save button is posting to the correct url."""
         response = self.get(self.CLUSTER_ADD_URL)
@@ -1266,9 +1359,9 @@ class StudentVectorGeneratorTests(actions.TestBase):
         self.raw_views_data = raw_views_data
 
     def test_inverse_submission_data(self):
-        """inverse_submission_data returns a dictionary keys by dimension id.
+        """inverse_submission_data returns a list with an entry by dimension.
 
-        For every dimension of submissions the dictionary has a value with the
+        For every dimension of submissions the list has a value with the
         same information as the original submission data. The value will
         be a list with all the submission relevant to that dimension.
         If an assessment is included inside a unit as pre or post assessment,
@@ -1283,17 +1376,17 @@ class StudentVectorGeneratorTests(actions.TestBase):
                 for submission in activity['submissions']:
                     for question in submission['answers']:
                         if question.get('question_id') == question_id:
-                            question['timestamp'] = submission['timestamp']
-                            result.append(question)
+                            result.append((submission['timestamp'], question))
                 return result
 
         # Treat as module-protected. pylint: disable=protected-access
         result = clustering.StudentVectorGenerator._inverse_submission_data(
             self.dimensions, self.raw_activities)
-        for dim in self.dimensions:
+        self.assertEqual(len(result), len(self.dimensions))
+        for index, dim in enumerate(self.dimensions):
             dim_type = dim[clustering.DIM_TYPE]
             dim_id = dim[clustering.DIM_ID]
-            entry = sorted(result[dim_type, dim_id])
+            entry = sorted(result[index])
             expected = None
             if dim_type == clustering.DIM_TYPE_UNIT:
                 expected = [activity for activity in self.raw_activities
@@ -1312,6 +1405,16 @@ class StudentVectorGeneratorTests(actions.TestBase):
                              msg='Bad entry {} {}: {}. Expected: {}'.format(
                                 dim_type, dim_id, entry, expected))
 
+    def test_inverse_submission_data_repeated_dimension(self):
+        """A repeated dimension has the same data in all its positions."""
+        dimensions = self.dimensions + self.dimensions
+        # Treat as module-protected. pylint: disable=protected-access
+        result = clustering.StudentVectorGenerator._inverse_submission_data(
+            dimensions, self.raw_activities)
+        size = len(self.dimensions)
+        self.assertEqual(result[:size], result[size:])
+        self.assertTrue(any(result[size:]))
+
     def test_inverse_page_view_data(self):
         """inverse_page_view_data returns a dictionary keys by dimension id.
         """
@@ -1351,6 +1454,30 @@ class StudentVectorGeneratorTests(actions.TestBase):
                 expected_dim[clustering.DIM_TYPE])
             self.assertEqual(expected_dim['expected_value'], obtained_value)
 
+    def test_map_reduce_vector_positions(self):
+        """The stored vector has the value of every dimension, in order.
+
+        This is testing the following extra cases:
+            - A unit with more than one scored lesson
+            - A question dimension repeated in the possible dimensions
+        """
+        self.dimensions[1][clustering.DIM_EXTRA_INFO] = json.dumps(
+            {'unit_scored_lessons': 2})
+        self.dimensions[1]['expected_value'] = 8.5 / 2
+        self.dimensions.append(dict(self.dimensions[3]))
+        self.run_generator_job()
+        student_vector = clustering.StudentVector.get_by_key_name(
+            str(self.aggregate_entity.key().name()))
+        vector = transforms.loads(student_vector.vector)
+        self.assertEqual(len(vector), len(self.dimensions))
+        for expected_dim, dim in zip(self.dimensions, vector):
+            self.assertEqual(expected_dim[clustering.DIM_TYPE],
+                             dim[clustering.DIM_TYPE])
+            self.assertEqual(expected_dim[clustering.DIM_ID],
+                             dim[clustering.DIM_ID])
+            self.assertEqual(expected_dim['expected_value'],
+                             dim[clustering.DIM_VALUE])
+
     def test_map_reduce_no_assessment(self):
         self.aggregate_entity.data = zlib.compress(transforms.dumps({}))
         self.aggregate_entity.put()
@@ -1368,11 +1495,11 @@ class StudentVectorGeneratorTests(actions.TestBase):
         # Treat as module-protected. pylint: disable=protected-access
         data = clustering.StudentVectorGenerator._inverse_submission_data(
             self.dimensions, self.raw_activities)
-        for dim in self.dimensions:
+        for index, dim in enumerate(self.dimensions):
             if dim[clustering.DIM_TYPE] == clustering.DIM_TYPE_UNIT:
                 # Treat as module-protected. pylint: disable=protected-access
                 value = clustering.StudentVectorGenerator._get_unit_score(
-                    data[dim[clustering.DIM_TYPE], dim[clustering.DIM_ID]], dim)
+                    data[index], dim)
                 self.assertEqual(value, dim['expected_value'])
 
     def test_get_lesson_score(self):
@@ -1384,10 +1511,10 @@ class StudentVectorGeneratorTests(actions.TestBase):
         # Treat as module-protected. pylint: disable=protected-access
         data = clustering.StudentVectorGenerator._inverse_submission_data(
             self.dimensions, self.raw_activities)
-        for dim in self.dimensions:
+        for index, dim in enumerate(self.dimensions):
             if dim[clustering.DIM_TYPE] == clustering.DIM_TYPE_LESSON:
                 value = clustering.StudentVectorGenerator._get_lesson_score(
-                    data[dim[clustering.DIM_TYPE], dim[clustering.DIM_ID]], dim)
+                    data[index], dim)
                 self.assertEqual(value, dim['expected_value'])
 
     def test_get_question_score(self):
@@ -1401,10 +1528,10 @@ class StudentVectorGeneratorTests(actions.TestBase):
         # Treat as module-protected. pylint: disable=protected-access
         data = clustering.StudentVectorGenerator._inverse_submission_data(
             self.dimensions, self.raw_activities)
-        for dim in self.dimensions:
+        for index, dim in enumerate(self.dimensions):
             if dim[clustering.DIM_TYPE] == clustering.DIM_TYPE_QUESTION:
                 value = clustering.StudentVectorGenerator._get_question_score(
-                    data[dim[clustering.DIM_TYPE], dim[clustering.DIM_ID]], dim)
+                    data[index], dim)
                 self.assertEqual(value, dim['expected_value'])
 
     def test_get_unit_visits(self):
@@ -1429,7 +1556,7 @@ class StudentVectorGeneratorTests(actions.TestBase):
         data = clustering.StudentVectorGenerator._inverse_submission_data(
             [extra_dimension], self.raw_activities)
         value = clustering.StudentVectorGenerator._get_unit_score(
-            data[extra_dimension[clustering.DIM_TYPE], '10'], extra_dimension)
+            data[0], extra_dimension)
         self.assertEqual(value, 0)
 
     def test_score_no_submitted_lesson(self):
@@ -1442,7 +1569,7 @@ class StudentVectorGeneratorTests(actions.TestBase):
         data = clustering.StudentVectorGenerator._inverse_submission_data(
             [extra_dimension], self.raw_activities)
         value = clustering.StudentVectorGenerator._get_lesson_score(
-            data[extra_dimension[clustering.DIM_TYPE], '10'], extra_dimension)
+            data[0], extra_dimension)
         self.assertEqual(value, 0)
 
     def test_score_no_submitted_question(self):
@@ -1455,7 +1582,7 @@ class StudentVectorGeneratorTests(actions.TestBase):
         data = clustering.StudentVectorGenerator._inverse_submission_data(
             [extra_dimension], self.raw_activities)
         value = clustering.StudentVectorGenerator._get_question_score(
-            data[extra_dimension[clustering.DIM_TYPE], '10'], extra_dimension)
+            data[0], extra_dimension)
         self.assertEqual(value, 0)
 
     def test_get_unit_score_multiple_lessons(self):
@@ -1480,6 +1607,31 @@ class StudentVectorGeneratorTests(actions.TestBase):
                          msg='Wrong score for unit with multiple lessons. '
                          'Expected {}. Got {}'.format(expected, value))
 
+    def test_get_unit_score_prepared_dimension(self):
+        """Unit dimensions prepared for the job score as the raw ones.
+
+        _prepare_mapper_params decodes the number of scored lessons of each
+        unit once, and a unit with 0 scored lessons counts as 1.
+        """
+        # Treat as module-protected. pylint: disable=protected-access
+        generator = clustering.StudentVectorGenerator
+        unused_dims, unused_indices, dispatch = (
+            generator._prepare_mapper_params(
+                {'possible_dimensions': self.dimensions}))
+        data = generator._inverse_submission_data(
+            self.dimensions, self.raw_activities)
+        for index, (unused_function, dim, unused_key) in enumerate(dispatch):
+            if dim[clustering.DIM_TYPE] != clustering.DIM_TYPE_UNIT:
+                continue
+            self.assertIn('_scored_lessons', dim)
+            value = generator._get_unit_score(data[index], dim)
+            self.assertEqual(value, generator._get_unit_score(
+                data[index], self.dimensions[index]))
+            self.assertEqual(value, dim['expected_value'])
+        # The first dimension has 'unit_scored_lessons': 0.
+        self.assertEqual(dispatch[0][1]['_scored_lessons'], 1)
+        self.assertEqual(generator._get_scored_lessons(self.dimensions[0]), 1)
+
 
 class StudentVectorGeneratorProgressTests(actions.TestBase):
     """Tests the calculation of the progress dimensions."""
@@ -1676,6 +1828,37 @@ class ClusteringGeneratorTests(actions.TestBase):
                              expected_distances2[index],
                              msg='Wrong distance vector {}'.format(index))
 
+    def test_mapreduce_clusters_inverted_range(self):
+        """Tests the distances of a cluster with an inverted range.
+
+        A dimension with a low limit greater than its high limit can't be
+        matched by any student, and the job must count it the same way as
+        hamming_distance does.
+        """
+        self._add_entities()
+        cluster_values = [(i, i*2) for i in range(1, self.dim_number+1)]
+        cluster_values[0] = (5, 1)
+        cluster_key = self._add_cluster(cluster_values)
+        cluster_vector = clustering.ClusterDAO.load(cluster_key).vector
+        self.run_generator_job()
+
+        found = 0
+        for index, key in enumerate(self.student_vector_keys):
+            student_vector = transforms.loads(
+                clustering.StudentVector.get_by_key_name(key.name()).vector)
+            expected = clustering.hamming_distance(cluster_vector,
+                                                   student_vector)
+            student_clusters = clustering.StudentClusters.get_by_key_name(
+                key.name())
+            clusters = transforms.loads(student_clusters.clusters)
+            if expected > clustering.ClusteringGenerator.MAX_DISTANCE:
+                self.assertNotIn(str(cluster_key), clusters)
+            else:
+                found += 1
+                self.assertEqual(clusters.get(str(cluster_key)), expected,
+                                 msg='Wrong distance vector {}'.format(index))
+        self.assertEqual(4, found)
+
     def test_mapreduce_stats(self):
         """Tests clusters stats generated after map reduce job.
 
@@ -1703,9 +1886,23 @@ class ClusteringGeneratorTests(actions.TestBase):
                       result)
         self.assertIn(['student_count', self.sv_number + 1], result)
 
-    def _check_hamming(self, cluster_vector, student_vector, value):
+    def test_mapreduce_stats_without_intersection(self):
+        """The intersection is not calculated if EMIT_INTERSECTION is False."""
+        self.swap(clustering.ClusteringGenerator, 'EMIT_INTERSECTION', False)
+        cluster1_key, cluster2_key = self._add_entities()
+        self.run_generator_job()
+        job = clustering.ClusteringGenerator(self.app_context).load()
+        result = jobs.MapReduceJob.get_results(job)
+        self.assertEqual(3, len(result), msg='Wrong response number')
+
+        self.assertIn(['count', [cluster1_key, [2, 1, 1]]], result)
+        self.assertIn(['count', [cluster2_key, [2]]], result)
+        self.assertIn(['student_count', self.sv_number + 1], result)
+
+    def _check_hamming(self, cluster_vector, student_vector, value,
+                       max_distance=None):
         self.assertEqual(clustering.hamming_distance(
-            cluster_vector, student_vector), value)
+            cluster_vector, student_vector, max_distance), value)
 
     def test_hamming_distance(self):
         cluster_vector = [
@@ -1731,6 +1928,23 @@ class ClusteringGeneratorTests(actions.TestBase):
         ]
         self._check_hamming(cluster_vector, student_vector, 1)
 
+    def test_hamming_max_distance(self):
+        """The calculation stops once the distance exceeds max_distance."""
+        cluster_vector = [
+            {clustering.DIM_TYPE: clustering.DIM_TYPE_UNIT,
+             clustering.DIM_ID: str(i),
+             clustering.DIM_HIGH: 10,
+             clustering.DIM_LOW: 5} for i in range(1, 4)]
+        student_vector = [
+            {clustering.DIM_TYPE: clustering.DIM_TYPE_UNIT,
+             clustering.DIM_ID: str(i),
+             clustering.DIM_VALUE: 20} for i in range(1, 4)]  # Don't match
+        self._check_hamming(cluster_vector, student_vector, 3)
+        self._check_hamming(cluster_vector, student_vector, 1, max_distance=0)
+        self._check_hamming(cluster_vector, student_vector, 2, max_distance=1)
+        self._check_hamming(cluster_vector, student_vector, 3, max_distance=2)
+        self._check_hamming(cluster_vector, student_vector, 3, max_distance=3)
+
     def test_hamming_equal_left(self):
         """The limit of the dimension range must be considered."""
         cluster_vector = [
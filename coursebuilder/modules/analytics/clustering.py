@@ -19,13 +19,14 @@ __author__ = 'Milagro Teruel (milit@google.com)'
 
 import appengine_config
 import collections
+import itertools
 import json
-import math
 import os
 import urllib
 import zlib
 
 from mapreduce import context
+from mapreduce import operation
 
 from common import schema_fields
 from controllers import utils
@@ -58,6 +59,18 @@ DIM_LOW = 'low'  # The lower bound. Optional
 DIM_EXTRA_INFO = 'extra-info'  # Optional
 DIM_VALUE = 'value'  # For students vectors. Optional
 
+# The course structure has no modification timestamp to invalidate the
+# cached dimensions, so they expire after a short time.
+POSSIBLE_DIMENSIONS_CACHE_TTL_SECS = 60
+_POSSIBLE_DIMENSIONS_MEMCACHE_KEY = 'clustering-possible-dimensions:{}'
+# The time of the last StudentAggregateGenerator run is shown every time the
+# visualization is rendered, so it is also cached for a short time.
+AGGREGATE_UPDATED_ON_CACHE_TTL_SECS = 30
+_AGGREGATE_UPDATED_ON_MEMCACHE_KEY = 'clustering-aggregate-updated-on'
+_AGGREGATE_UPDATED_MESSAGE = (
+    'The student aggregated values where last calculated on {}.')
+_AGGREGATE_NEVER_RUN_MESSAGE = 'The student aggregated job has never run.'
+
 
 class ClusterEntity(BaseEntity):
     """Representation of a cluster used for clasification of students.
@@ -112,7 +125,7 @@ def pack_question_dimid(unit_id, lesson_id, question_id):
 
     Returns:
         A string with the dimension id."""
-    return ':'.join((str(unit_id), str(lesson_id), str(question_id)))
+    return '%s:%s:%s' % (unit_id, lesson_id, question_id)
 
 
 def unpack_question_dimid(dimension_id):
@@ -123,7 +136,7 @@ def unpack_question_dimid(dimension_id):
         unit_id and question_id are strings. lesson_id can be a string or
         None.
     """
-    unit_id, lesson_id, question_id = dimension_id.split(':')
+    unit_id, lesson_id, question_id = dimension_id.split(':', 2)
     if lesson_id == 'None':
         lesson_id = None
     return unit_id, lesson_id, question_id
@@ -195,6 +208,21 @@ def _has_left_side(dim):
     return dim.get(DIM_LOW) != None and dim.get(DIM_LOW) != ''
 
 
+def _coerce_range_value(value):
+    """Converts the value of one side of a dimension range to float.
+
+    Returns:
+        A tuple (valid, number). number is None if value is None or '',
+        and valid is False if value is not a number.
+    """
+    if value is None or value == '':
+        return True, None
+    try:
+        return True, float(value)
+    except ValueError:
+        return False, None
+
+
 def _add_unit_visits(unit, result):
     new_dim = {
         DIM_TYPE: DIM_TYPE_UNIT_VISIT,
@@ -282,7 +310,26 @@ def get_possible_dimensions(app_context):
 
     For more details in the structure of dimensions see ClusterEntity
     documentation.
+
+    The result is cached in memcache for a short time, so changes in the
+    course structure may take up to POSSIBLE_DIMENSIONS_CACHE_TTL_SECS
+    seconds to be listed in the cluster editor. The StudentVectorGenerator
+    job does not use this cache and always sees the current course.
     """
+    namespace = app_context.get_namespace_name()
+    key = _POSSIBLE_DIMENSIONS_MEMCACHE_KEY.format(
+        app_context.get_current_locale())
+    result = models.MemcacheManager.get(key, namespace=namespace)
+    if result is None:
+        result = _build_possible_dimensions(app_context)
+        models.MemcacheManager.set(
+            key, result, ttl=POSSIBLE_DIMENSIONS_CACHE_TTL_SECS,
+            namespace=namespace)
+    return result
+
+
+def _build_possible_dimensions(app_context):
+    """Builds the list of dimensions returned by get_possible_dimensions."""
     datasource = gradebook.OrderedQuestionsDataSource()
     template_values = {}
     # This has extra information but it was already implemented.
@@ -360,6 +407,7 @@ class ClusterRESTHandler(dto_editor.BaseDatastoreRestHandler):
         to_select = []
         dim_types = {}
         if app_context:
+            # Possibly stale for a few seconds after the course is edited.
             dimensions = get_possible_dimensions(app_context)
             for dim in dimensions:
                 select_id = cls.pack_id(dim[DIM_ID], dim[DIM_TYPE])
@@ -428,21 +476,13 @@ class ClusterRESTHandler(dto_editor.BaseDatastoreRestHandler):
                      'range (dimension number {}).')
         # Convert to float and complete the missing ranges with None.
         for index, dim in enumerate(item_dict['vector']):
-            if _has_right_side(dim):
-                try:
-                    dim[DIM_HIGH] = float(dim[DIM_HIGH])
-                except ValueError:
-                    errors.append(error_str.format(index))
-            else:
-                dim[DIM_HIGH] = None
-            if _has_left_side(dim):
-                try:
-                    dim[DIM_LOW] = float(dim[DIM_LOW])
-                except ValueError:
+            for side in (DIM_HIGH, DIM_LOW):
+                valid, value = _coerce_range_value(dim.get(side))
+                if valid:
+                    dim[side] = value
+                else:
                     errors.append(error_str.format(index))
-            else:
-                dim[DIM_LOW] = None
-            if (_has_left_side(dim) and _has_right_side(dim)
+            if (dim[DIM_LOW] is not None and dim[DIM_HIGH] is not None
                 and dim[DIM_HIGH] < dim[DIM_LOW]):
                 errors.append(
                     'Wrong range interval in dimension number {}'.format(index))
@@ -493,6 +533,22 @@ class StudentVector(BaseEntity):
         if candidates:
             return candidates[0]
 
+    @staticmethod
+    def get_dimension_lookup(vector):
+        """Returns a dictionary with the values of the dimensions in vector.
+
+        The keys are tuples (type, id), with the id converted to string. If a
+        dimension is repeated in the vector, the first value is used.
+
+        Args:
+            vector: A list of dictionaries. Corresponds to the StudentVector
+            vector attribute unpacked.
+        """
+        lookup = {}
+        for dim in reversed(vector):
+            lookup[dim[DIM_TYPE], str(dim[DIM_ID])] = dim[DIM_VALUE]
+        return lookup
+
 
 class StudentClusters(BaseEntity):
     """Representation of the relation between StudentVector and ClusterEntity.
@@ -512,6 +568,27 @@ class StudentClusters(BaseEntity):
         return db.Key.from_path(cls.kind(), transform_fn(db_key.id_or_name()))
 
 
+# Values derived from the mapper parameters of a running job, by name. See
+# _get_prepared_mapper_params.
+_PREPARED_MAPPER_PARAMS = {}
+
+
+def _get_prepared_mapper_params(name, prepare_function):
+    """Returns prepare_function(mapper_params) for the current map reduce.
+
+    The map functions are called once for each entity in a shard. The values
+    that depend only on the mapper parameters are prepared with
+    prepare_function the first time and kept in the instance until a
+    different map reduce job asks for the same name.
+    """
+    spec = context.get().mapreduce_spec
+    prepared = _PREPARED_MAPPER_PARAMS.get(name)
+    if prepared is None or prepared[0] != spec.mapreduce_id:
+        prepared = (spec.mapreduce_id, prepare_function(spec.mapper.params))
+        _PREPARED_MAPPER_PARAMS[name] = prepared
+    return prepared[1]
+
+
 class StudentVectorGenerator(jobs.MapReduceJob):
     """A map reduce job to create StudentVector.
 
@@ -568,7 +645,7 @@ class StudentVectorGenerator(jobs.MapReduceJob):
         return student_aggregate.StudentAggregateEntity
 
     def build_additional_mapper_params(self, app_context):
-        return {'possible_dimensions': get_possible_dimensions(app_context)}
+        return {'possible_dimensions': _build_possible_dimensions(app_context)}
 
     @staticmethod
     def map(item):
@@ -577,48 +654,83 @@ class StudentVectorGenerator(jobs.MapReduceJob):
         Creates a new StudentVector using the id of the item, a
         StudentAggregateEntity. Calculates the value for every dimension
         from the assessment data in item.
-        """
-        mapper_params = context.get().mapreduce_spec.mapper.params
-        raw_data = transforms.loads(zlib.decompress(item.data))
 
+        Yields:
+            The operation to put the new StudentVector.
+        """
+        dimensions, dimension_indices, dispatch = _get_prepared_mapper_params(
+            'student_vectors', StudentVectorGenerator._prepare_mapper_params)
+        # The data handled by the clustering jobs is never rendered in a
+        # page, so it is encoded with json directly. transforms.dumps
+        # escapes the output character by character for XSS protection.
+        raw_data = json.loads(zlib.decompress(item.data))
         raw_assessments = raw_data.get('assessments', [])
-        sub_data = StudentVectorGenerator._inverse_submission_data(
-            mapper_params['possible_dimensions'], raw_assessments)
-
         raw_page_views = raw_data.get('page_views', [])
+        # Only the assessments and page views are used. Release the rest of
+        # the aggregate before the datastore calls below.
+        del raw_data
+
+        sub_data = StudentVectorGenerator._inverse_submission_data(
+            dimensions, raw_assessments, dimension_indices)
         view_data = StudentVectorGenerator._inverse_page_view_data(
             raw_page_views)
+        has_submissions = bool(raw_assessments)
+        del raw_assessments, raw_page_views
 
         progress_data = None
         user_id = item.key().name()
         student = models.Student.get_by_user_id(user_id)
         if student:
-            raw_data = models.StudentPropertyEntity.get(
+            progress_property = models.StudentPropertyEntity.get(
                 student, progress.UnitLessonCompletionTracker.PROPERTY_KEY)
-            if hasattr(raw_data, 'value') and raw_data.value:
-                progress_data = transforms.loads(raw_data.value)
+            if (hasattr(progress_property, 'value') and
+                progress_property.value):
+                progress_data = transforms.loads(progress_property.value)
 
-        if not (sub_data or view_data or progress_data):
+        if not (has_submissions or view_data or progress_data):
             return
 
         vector = []
-        for dim in mapper_params['possible_dimensions']:
-            type_ = dim[DIM_TYPE]
+        for index, (function, dim, key) in enumerate(dispatch):
+            type_ = key[0]
             if type_ == DIM_TYPE_UNIT_VISIT:
-                data_for_dimension = view_data[type_, str(dim[DIM_ID])]
+                data_for_dimension = view_data[key]
             elif type_ in [DIM_TYPE_UNIT_PROGRESS, DIM_TYPE_LESSON_PROGRESS]:
                 data_for_dimension = progress_data
             else:
-                data_for_dimension = sub_data[type_, str(dim[DIM_ID])]
-            value = StudentVectorGenerator.get_function_for_dimension(
-                        dim[DIM_TYPE])(data_for_dimension, dim)
+                data_for_dimension = sub_data[index]
             new_dim = {
-                DIM_TYPE: dim[DIM_TYPE],
+                DIM_TYPE: type_,
                 DIM_ID: dim[DIM_ID],
-                DIM_VALUE: value}
+                DIM_VALUE: function(data_for_dimension, dim)}
             vector.append(new_dim)
-        StudentVector(key_name=str(item.key().name()),
-                      vector=transforms.dumps(vector)).put()
+        # The framework batches the puts of the whole slice.
+        yield operation.db.Put(StudentVector(key_name=str(item.key().name()),
+                                             vector=json.dumps(vector)))
+
+    @staticmethod
+    def _prepare_mapper_params(mapper_params):
+        """Resolves the score function of every dimension.
+
+        Returns:
+            A tuple with the possible dimensions, their indices as returned
+            by _get_dimension_indices and a list of tuples
+            (function, dimension, (type, id)), one for each dimension in
+            the same order.
+        """
+        dimensions = mapper_params['possible_dimensions']
+        dispatch = []
+        for dim in dimensions:
+            if dim[DIM_TYPE] == DIM_TYPE_UNIT:
+                dim = dict(dim, _scored_lessons=(
+                    StudentVectorGenerator._get_scored_lessons(dim)))
+            dispatch.append((
+                StudentVectorGenerator.get_function_for_dimension(
+                    dim[DIM_TYPE]),
+                dim, (dim[DIM_TYPE], str(dim[DIM_ID]))))
+        return (dimensions,
+                StudentVectorGenerator._get_dimension_indices(dimensions),
+                dispatch)
 
     @staticmethod
     def reduce(item_id, values):
@@ -626,32 +738,67 @@ class StudentVectorGenerator(jobs.MapReduceJob):
         pass
 
     @staticmethod
-    def _inverse_submission_data(dimensions, raw_data):
-        """Build a dictionary with the information from raw_data by dimension.
+    def _get_dimension_indices(dimensions):
+        """Maps the (type, id) of every dimension to its positions.
+
+        The same dimension can be repeated in the list, for example a
+        question used twice in the same lesson, so each (type, id) has a
+        list with all its positions.
+        """
+        result = collections.defaultdict(list)
+        for index, dim in enumerate(dimensions):
+            result[dim[DIM_TYPE], str(dim[DIM_ID])].append(index)
+        return dict(result)
+
+    @staticmethod
+    def _inverse_submission_data(dimensions, raw_data,
+                                 dimension_indices=None):
+        """Build a list with the information from raw_data by dimension.
 
         For each dimension builds an entry in the result. The value is a list
         with all the submissions relevant to that dimension. The concept of
         relevant is different for each type of dimension. For example, for a
         unit the relevant data are the submissions of all lessons for that
-        unit.
+        unit. For questions, the relevant data are tuples (timestamp, answer)
+        with each answer to the question and the timestamp of its
+        submission. Submissions for units, lessons or questions that are not
+        in dimensions are ignored.
+
+        Args:
+            dimensions: the list of possible dimensions.
+            raw_data: the list of activities of a StudentAggregateEntity.
+            dimension_indices: optional, the result of
+                _get_dimension_indices(dimensions), to avoid building it for
+                every student.
 
         Returns:
-            An instance of defaultdict with default empty list."""
-        result = collections.defaultdict(lambda: [])
+            A list with an entry for each dimension, in the same order as
+            dimensions. Repeated dimensions get the same data."""
+        if dimension_indices is None:
+            dimension_indices = StudentVectorGenerator._get_dimension_indices(
+                dimensions)
+        result = [[] for _ in dimensions]
         for activity in raw_data:
             activity_lesson = activity.get('lesson_id')
             activity_unit = activity.get('unit_id')
             # This creates aliasing but it's fine beacuse is read only.
-            # It only adds a copy of the timestamp for the questions.
-            result[DIM_TYPE_UNIT, activity_unit].append(activity)
-            result[DIM_TYPE_LESSON, activity_lesson].append(activity)
+            for index in dimension_indices.get(
+                    (DIM_TYPE_UNIT, activity_unit), ()):
+                result[index].append(activity)
+            for index in dimension_indices.get(
+                    (DIM_TYPE_LESSON, activity_lesson), ()):
+                result[index].append(activity)
+            # Same as pack_question_dimid, without repeating the unit and
+            # lesson conversions for every answer.
+            dim_id_prefix = '%s:%s:' % (activity_unit, activity_lesson)
             for submission in activity.get('submissions', []):
                 for answer in submission.get('answers', []):
                     question_id = answer.get('question_id')
-                    answer['timestamp'] = submission['timestamp']
-                    dim_id = pack_question_dimid(activity_unit,
-                                                 activity_lesson, question_id)
-                    result[DIM_TYPE_QUESTION, dim_id].append(answer)
+                    for index in dimension_indices.get(
+                            (DIM_TYPE_QUESTION,
+                             dim_id_prefix + str(question_id)), ()):
+                        result[index].append(
+                            (submission['timestamp'], answer))
         return result
 
     @staticmethod
@@ -665,7 +812,7 @@ class StudentVectorGenerator(jobs.MapReduceJob):
 
         Returns:
             An instance of defaultdict with default empty list."""
-        result = collections.defaultdict(lambda: [])
+        result = collections.defaultdict(list)
         for page_view in raw_data:
             name = page_view.get('name')
             if name not in ['unit', 'assessment']:
@@ -683,22 +830,23 @@ class StudentVectorGenerator(jobs.MapReduceJob):
         submission. If there is no submission for the question the score is 0.
 
         Args:
-            data: a list of dictionaries.
+            data: a list of tuples (timestamp, answer), where answer is a
+                dictionary.
         """
         if not data:
             return 0
         last_scores = []
         last_timestamp = 0
-        for answer in data:
+        for timestamp, answer in data:
             # Could be more than one question with the same timestamp
             score = answer.get('weighted_score')
-            if score and answer['timestamp'] > last_timestamp:
+            if score and timestamp > last_timestamp:
                 last_scores = [score]
-                last_timestamp = answer['timestamp']
-            elif score and answer['timestamp'] == last_timestamp:
+                last_timestamp = timestamp
+            elif score and timestamp == last_timestamp:
                 last_scores.append(score)
         if last_scores:
-            return math.fsum(last_scores) / len(last_scores)
+            return sum(last_scores) / float(len(last_scores))
         return 0
 
     @staticmethod
@@ -712,6 +860,19 @@ class StudentVectorGenerator(jobs.MapReduceJob):
                 return submission['last_score']
         return 0
 
+    @staticmethod
+    def _get_scored_lessons(dimension):
+        """Returns the number of scored lessons of a unit dimension.
+
+        The number is read from the DIM_EXTRA_INFO field and it is at
+        least 1."""
+        if not DIM_EXTRA_INFO in dimension:
+            return 1
+        extra_info = json.loads(dimension[DIM_EXTRA_INFO])
+        if not 'unit_scored_lessons' in extra_info:
+            return 1
+        return max(extra_info['unit_scored_lessons'], 1)
+
     @staticmethod
     def _get_unit_score(data, dimension):
         """The score of a unit is the average score of its scored lessons.
@@ -721,14 +882,12 @@ class StudentVectorGenerator(jobs.MapReduceJob):
         """
         if not data:
             return 0
-        if not DIM_EXTRA_INFO in dimension:
-            scored_lessons = 1
-        else:
-            extra_info = json.loads(dimension[DIM_EXTRA_INFO])
-            if not 'unit_scored_lessons' in extra_info:
-                scored_lessons = 1
-            else:
-                scored_lessons = max(extra_info['unit_scored_lessons'], 1)
+        # Dimensions prepared by _prepare_mapper_params carry the value
+        # already decoded.
+        scored_lessons = dimension.get('_scored_lessons')
+        if scored_lessons is None:
+            scored_lessons = StudentVectorGenerator._get_scored_lessons(
+                dimension)
         score = 0
         for submission in data:
             if ('unit_id' in submission and 'last_score' in submission
@@ -779,7 +938,7 @@ class StudentVectorGenerator(jobs.MapReduceJob):
         return 0
 
 
-def hamming_distance(vector, student_vector):
+def hamming_distance(vector, student_vector, max_distance=None):
     """Return the hamming distance between a ClusterEntity and a StudentVector.
 
     The hamming distance between an ClusterEntity and a StudentVector is the
@@ -791,10 +950,10 @@ def hamming_distance(vector, student_vector):
     Params:
         vector: the vector field of a ClusterEntity instance.
         student_vector: the vector field of a StudentVector instance.
+        max_distance: optional number. If given, the calculation stops as
+            soon as the distance is greater than max_distance, and that
+            partial distance is returned.
     """
-    # TODO(milit): As we are discarding all distances greater than
-    # ClusteringGenerator.MAX_DISTANCE, add it as a parameter so we stop
-    # calculating the distance once this limit is reached.
     def fits_left_side(dim, value):
         """_has_left_side(dim) -> dim[DIM_LOW] <= value"""
         return not _has_left_side(dim) or dim[DIM_LOW] <= value
@@ -803,17 +962,95 @@ def hamming_distance(vector, student_vector):
         """_has_right_side(dim) -> dim[DIM_HIGH] >= value"""
         return not _has_right_side(dim) or dim[DIM_HIGH] >= value
 
+    lookup = StudentVector.get_dimension_lookup(student_vector)
     distance = 0
     for dim in vector:
-        value = StudentVector.get_dimension_value(student_vector,
-                                                  dim[DIM_ID], dim[DIM_TYPE])
+        value = lookup.get((dim[DIM_TYPE], str(dim[DIM_ID])))
         if not value:
             value = 0
         if not fits_left_side(dim, value) or not fits_right_side(dim, value):
             distance += 1
+            if max_distance is not None and distance > max_distance:
+                break
     return distance
 
 
+def _cluster_distances(clusters, values, max_distance):
+    """Returns the hamming distances between a student and all the clusters.
+
+    Equivalent to calling hamming_distance for every cluster, but works over
+    the representation built by
+    ClusteringGenerator.build_additional_mapper_params: each cluster holds
+    the indexes and values of its low limits and of its high limits, and the
+    student values are a list aligned to the same dimension indexes. All the
+    clusters are processed in a single call to avoid the cost of a function
+    call per cluster.
+
+    Params:
+        clusters: a list of tuples (id, empty_ranges, low_indices, lows,
+            high_indices, highs), from the dictionaries built in
+            ClusteringGenerator.build_additional_mapper_params.
+        values: a list with the value of the student for each dimension.
+        max_distance: clusters at a greater distance are not returned.
+
+    Returns:
+        A list of tuples (cluster_id, distance), in the same order as
+        clusters, only for the clusters at distance max_distance or less.
+    """
+    izip = itertools.izip
+    result = []
+    for (cluster_id, distance, low_indices, lows, high_indices,
+         highs) in clusters:
+        # A value can't be under the low limit and over the high limit of
+        # the same dimension, so each dimension adds at most 1.
+        for index, low in izip(low_indices, lows):
+            if values[index] < low:
+                distance += 1
+                if distance > max_distance:
+                    break
+        else:
+            for index, high in izip(high_indices, highs):
+                if values[index] > high:
+                    distance += 1
+                    if distance > max_distance:
+                        break
+        if distance <= max_distance:
+            result.append((cluster_id, distance))
+    return result
+
+
+def _distance_histogram(distances, cumulative):
+    """Converts the number of students by distance into a list.
+
+    Params:
+        distances: a dictionary from distance, an integer, to number of
+            students.
+        cumulative: a boolean, whether to accumulate the numbers.
+
+    Returns:
+        A list with an element for every distance from 0 to the greatest
+        distance in distances. The i-th element is the number of students
+        at distance i, or at distance less or equal than i if cumulative
+        is True.
+    """
+    size = max(distances) + 1
+    if cumulative:
+        # Accumulate the distances while copying them.
+        list_distances = []
+        total = 0
+        for distance in range(size):
+            total += distances.get(distance, 0)
+            list_distances.append(total)
+    else:
+        if size <= len(_ZERO_DISTANCES):
+            list_distances = _ZERO_DISTANCES[:size]
+        else:
+            list_distances = [0] * size
+        for distance, count in distances.iteritems():
+            list_distances[distance] = count
+    return list_distances
+
+
 class ClusteringGenerator(jobs.MapReduceJob):
     """A map reduce job to calculate which students belong to each cluster.
 
@@ -831,8 +1068,11 @@ class ClusteringGenerator(jobs.MapReduceJob):
     students in each cluster and the intersection of pairs of clusters.
     """
     MAX_DISTANCE = 2
+    # The intersection of pairs of clusters is the heaviest statistic: the
+    # map yields a pair for every two clusters each student belongs to.
+    # Subclasses can set this to False to skip it.
+    EMIT_INTERSECTION = True
 
-    # TODO(milit): Add settings to disable heavy statistics.
     @staticmethod
     def get_description():
         return 'StudentVector clusterization'
@@ -842,13 +1082,79 @@ class ClusteringGenerator(jobs.MapReduceJob):
         return models.Student
 
     def build_additional_mapper_params(self, app_context):
-        clusters = [{'id': cluster.id, 'vector': cluster.vector}
-                    for cluster in ClusterDAO.get_all()]
+        """Prepares the clusters to be compared against every student.
+
+        All the dimensions used by the clusters are numbered in the list
+        'dimensions', with the pairs (type, id). Each cluster vector is
+        parsed once here into the parallel lists 'low_indices' and 'lows'
+        with the dimensions that have a low limit, and 'high_indices' and
+        'highs' with the dimensions that have a high limit. Dimensions with
+        a low limit greater than the high limit can't be matched by any
+        student and are only counted in 'empty_ranges'.
+        """
+        dimensions = []
+        dimension_index = {}
+        clusters = []
+        for cluster in ClusterDAO.get_all():
+            new_cluster = {
+                'id': cluster.id,
+                'empty_ranges': 0,
+                'low_indices': [],
+                'lows': [],
+                'high_indices': [],
+                'highs': []}
+            for dim in cluster.vector:
+                key = (dim[DIM_TYPE], str(dim[DIM_ID]))
+                if key not in dimension_index:
+                    dimension_index[key] = len(dimensions)
+                    dimensions.append(key)
+                index = dimension_index[key]
+                has_low = _has_left_side(dim)
+                has_high = _has_right_side(dim)
+                if has_low and has_high and dim[DIM_LOW] > dim[DIM_HIGH]:
+                    new_cluster['empty_ranges'] += 1
+                    continue
+                if has_low:
+                    new_cluster['low_indices'].append(index)
+                    new_cluster['lows'].append(dim[DIM_LOW])
+                if has_high:
+                    new_cluster['high_indices'].append(index)
+                    new_cluster['highs'].append(dim[DIM_HIGH])
+            clusters.append(new_cluster)
         return {
+            'dimensions': dimensions,
             'clusters': clusters,
-            'max_distance': getattr(self, 'MAX_DISTANCE', 2)
+            'max_distance': getattr(self, 'MAX_DISTANCE', 2),
+            'emit_intersection': getattr(self, 'EMIT_INTERSECTION', True)
         }
 
+    @staticmethod
+    def _prepare_mapper_params(mapper_params):
+        """Unpacks the mapper params in the form used by map for each student.
+
+        Returns:
+            A tuple (dimensions, clusters, max_distance, emit_intersection),
+            where dimensions is a list of tuples (type, id) and clusters is a
+            list of tuples as expected by _cluster_distances.
+        """
+        dimensions = [tuple(dim) for dim in mapper_params['dimensions']]
+        clusters = [
+            (cluster['id'], cluster['empty_ranges'], cluster['low_indices'],
+             cluster['lows'], cluster['high_indices'], cluster['highs'])
+            for cluster in mapper_params['clusters']]
+        return (dimensions, clusters, mapper_params['max_distance'],
+                mapper_params.get('emit_intersection', True))
+
+    @staticmethod
+    def _get_aligned_values(student_vector, dimensions):
+        """Returns the values of student_vector aligned to dimensions.
+
+        Dimensions not present in the student vector have value 0. If a
+        dimension is repeated in the student vector, the first value is used.
+        """
+        lookup = StudentVector.get_dimension_lookup(student_vector)
+        return [lookup.get(dim) or 0 for dim in dimensions]
+
     @staticmethod
     def map(item):
         """Calculates the distance from the StudentVector to ClusterEntites.
@@ -866,28 +1172,40 @@ class ClusteringGenerator(jobs.MapReduceJob):
                     the distance to the second cluster in the tuple.
                 3.  A string 'student_count' with value 1.
             One result is yielded for every cluster id and pair of clusters
-            ids. If (cluster1_id, cluster2_id) is yielded, then
+            ids. The pairs are not yielded if emit_intersection is False in
+            the mapper params. If (cluster1_id, cluster2_id) is yielded, then
             (cluster2_id, cluster1_id) won't be yielded.
+            It also yields the operation to put the StudentClusters of the
+            student.
         """
         student = StudentVector.get_by_key_name(item.user_id)
         if student:
-            mapper_params = context.get().mapreduce_spec.mapper.params
-            max_distance = mapper_params['max_distance']
-            clusters = {}
-            item_vector = transforms.loads(student.vector)
-            for cluster in mapper_params['clusters']:
-                distance = hamming_distance(cluster['vector'], item_vector)
-                if distance > max_distance:
-                    continue
-                for cluster2_id, distance2 in clusters.items():
-                    key = transforms.dumps((cluster2_id, cluster['id']))
-                    value = (item.user_id, distance, distance2)
-                    yield (key, transforms.dumps(value))
-                clusters[cluster['id']] = distance
-                to_yield = (item.user_id, distance)
-                yield(cluster['id'], transforms.dumps(to_yield))
-            clusters = transforms.dumps(clusters)
-            StudentClusters(key_name=item.user_id, clusters=clusters).put()
+            dimensions, all_clusters, max_distance, emit_intersection = (
+                _get_prepared_mapper_params(
+                    'clustering', ClusteringGenerator._prepare_mapper_params))
+            clusters = []
+            values = ClusteringGenerator._get_aligned_values(
+                json.loads(student.vector), dimensions)
+            # The emitted keys and values are json lists. The student id is
+            # the only element that needs escaping, so it is encoded once
+            # and the lists are formatted directly, without spaces to keep
+            # the shuffle small.
+            user_id = json.dumps(item.user_id)
+            for cluster_id, distance in _cluster_distances(
+                    all_clusters, values, max_distance):
+                if emit_intersection:
+                    for cluster2_id, distance2 in clusters:
+                        key = '[%d,%d]' % (cluster2_id, cluster_id)
+                        value = '[%s,%d,%d]' % (user_id, distance, distance2)
+                        yield (key, value)
+                clusters.append((cluster_id, distance))
+                yield (cluster_id, '[%s,%d]' % (user_id, distance))
+            # The same json object json.dumps would produce from a dictionary
+            # of cluster ids to distances, without the separator spaces.
+            clusters = '{%s}' % ','.join(
+                ['"%d":%d' % cluster for cluster in clusters])
+            yield operation.db.Put(StudentClusters(key_name=item.user_id,
+                                                   clusters=clusters))
         yield ('student_count', 1)
 
     @staticmethod
@@ -938,12 +1256,12 @@ class ClusteringGenerator(jobs.MapReduceJob):
         if item_id == 'student_count':
             yield (item_id, sum(int(value) for value in values))
         else:
-            item_id = transforms.loads(item_id)
-            distances = collections.defaultdict(lambda: 0)
+            item_id = json.loads(item_id)
+            distances = collections.defaultdict(int)
             if isinstance(item_id, list):
                 stat_name = 'intersection'
                 for value in values:
-                    value = transforms.loads(value)
+                    value = json.loads(value)
                     # If a student vector has a distance 1 to cluster A
                     # and distance 3 to cluster B, then it has a
                     # distance of 3 (the greater) to the intersection
@@ -953,17 +1271,17 @@ class ClusteringGenerator(jobs.MapReduceJob):
             else:
                 stat_name = 'count'
                 for value in values:
-                    value = transforms.loads(value)
+                    value = json.loads(value)
                     distances[value[1]] += 1
-            distances = dict(distances)
-            list_distances = [0] * (max([int(k) for k in distances]) + 1)
-            for distance, count in distances.items():
-                list_distances[int(distance)] = count
-            if stat_name == 'intersection':
-                # Accumulate the distances.
-                for index in range(1, len(list_distances)):
-                    list_distances[index] += list_distances[index - 1]
-            yield transforms.dumps((stat_name, (item_id, list_distances)))
+            list_distances = _distance_histogram(
+                distances, stat_name == 'intersection')
+            yield json.dumps((stat_name, (item_id, list_distances)),
+                             separators=(',', ':'))
+
+
+# Copied by _distance_histogram for the count statistics, which have at most
+# a value for each distance up to MAX_DISTANCE.
+_ZERO_DISTANCES = [0] * (ClusteringGenerator.MAX_DISTANCE + 1)
 
 
 class TentpoleStudentVectorDataSource(data_sources.SynchronousQuery):
@@ -983,22 +1301,42 @@ class TentpoleStudentVectorDataSource(data_sources.SynchronousQuery):
     def required_generators():
         return [StudentVectorGenerator]
 
+    @staticmethod
+    def _get_aggregate_updated_on(app_context):
+        """Returns when the StudentAggregateGenerator last ran, or None.
+
+        The time is formatted with utils.HUMAN_READABLE_DATETIME_FORMAT and
+        cached in memcache for AGGREGATE_UPDATED_ON_CACHE_TTL_SECS seconds,
+        so it is not formatted again for every render. A job that never ran
+        is not cached, so its first run is shown as soon as it is recorded.
+        """
+        namespace = app_context.get_namespace_name()
+        updated_on = models.MemcacheManager.get(
+            _AGGREGATE_UPDATED_ON_MEMCACHE_KEY, namespace=namespace)
+        if updated_on is None:
+            job = student_aggregate.StudentAggregateGenerator(
+                app_context).load()
+            updated_on = getattr(job, 'updated_on', None)
+            if not updated_on:
+                return None
+            updated_on = updated_on.strftime(
+                utils.HUMAN_READABLE_DATETIME_FORMAT)
+            models.MemcacheManager.set(
+                _AGGREGATE_UPDATED_ON_MEMCACHE_KEY, updated_on,
+                ttl=AGGREGATE_UPDATED_ON_CACHE_TTL_SECS, namespace=namespace)
+        return updated_on
+
     @staticmethod
     def fill_values(app_context, template_values, unused_gen):
         """Check if the StudentAggregateGenerator has run."""
-        job = student_aggregate.StudentAggregateGenerator(app_context).load()
-        if not job:
-            template_values['message'] = ('The student aggregated job has '
-                                          'never run.')
-        message_str = ('The student aggregated values where '
-                       'last calculated on {}.')
-        last_update = getattr(job, 'updated_on', None)
-        if not last_update:
-            template_values['message'] = ('The student aggregated job has '
-                                          'never run.')
+        last_update = (
+            TentpoleStudentVectorDataSource._get_aggregate_updated_on(
+                app_context))
+        if last_update:
+            message = _AGGREGATE_UPDATED_MESSAGE.format(last_update)
         else:
-            template_values['message'] = message_str.format(
-                job.updated_on.strftime(utils.HUMAN_READABLE_DATETIME_FORMAT))
+            message = _AGGREGATE_NEVER_RUN_MESSAGE
+        template_values['message'] = message
 
 
 class ClusterStatisticsDataSource(data_sources.AbstractSmallRestDataSource):
@@ -1028,37 +1366,46 @@ class ClusterStatisticsDataSource(data_sources.AbstractSmallRestDataSource):
             return iterable + [0] * (length - len(iterable))
 
         def process_count(value, count):
-            if value[0] not in count:
+            cluster_count = count.get(value[0])
+            if cluster_count is None:
                 return
-            count[value[0]][1:] = add_zeros(value[1], max_distance + 1)
+            cluster_count[1:] = add_zeros(value[1], max_distance + 1)
 
         def process_intersection(value, count, inter):
             cluster1, cluster2 = value[0]
-            if not (cluster2 in count and cluster1 in count):
+            count1 = count.get(cluster1)
+            count2 = count.get(cluster2)
+            if count1 is None or count2 is None:
                 return
-            map1 = id_mapping.index(cluster1)
-            map2 = id_mapping.index(cluster2)
+            map1 = id_index[cluster1]
+            map2 = id_index[cluster2]
+            # The job stops the accumulated counts at the greatest distance
+            # seen. Complete the missing values with the last one.
+            int_counts = value[1] + [value[1][-1]] * (
+                max_distance + 1 - len(value[1]))
+            c1_count = 0
+            c2_count = 0
             for dist in range(max_distance + 1):  # Include the last one
-                c1_count = sum(count[cluster1][1:dist + 2])
-                c2_count = sum(count[cluster2][1:dist + 2])
-                if dist >= len(value[1]):  # Complete missing values
-                    int_count = value[1][-1]
-                else:
-                    int_count = value[1][dist]  # We know is not empty
-                inter[dist]['count'][map1][map2] = int_count
+                c1_count += count1[dist + 1]
+                c2_count += count2[dist + 1]
+                int_count = int_counts[dist]
+                inter[dist]['count'].setdefault(map1, {})[map2] = int_count
 
                 percentage = round(int_count*100/float(student_count), 2)
-                inter[dist]['percentage'][map1][map2] = percentage
+                inter[dist]['percentage'].setdefault(map1, {})[map2] = (
+                    percentage)
                 # P(c2 | c1) = count(c1 and c2) / count(c1)
                 probability = 0
                 if c1_count:
                     probability = round(int_count/float(c1_count), 2)
-                inter[dist]['probability'][map1][map2] = probability
+                inter[dist]['probability'].setdefault(map1, {})[map2] = (
+                    probability)
                 # P(c1 | c2) = count(c1 and c2) / count(c2)
                 probability = 0
                 if c2_count:
                     probability = round(int_count/float(c2_count), 2)
-                inter[dist]['probability'][map2][map1] = probability
+                inter[dist]['probability'].setdefault(map2, {})[map1] = (
+                    probability)
 
         max_distance = ClusteringGenerator.MAX_DISTANCE
         student_count = 1
@@ -1069,25 +1416,24 @@ class ClusterStatisticsDataSource(data_sources.AbstractSmallRestDataSource):
             dimension_count[cluster.id] = len(cluster.vector)
 
         id_mapping = count.keys()
+        id_index = dict((cid, index) for index, cid in enumerate(id_mapping))
         name_mapping = [count[cid][0] for cid in id_mapping]
 
-        l = lambda: collections.defaultdict(l)
-        inter = [{'count': l(), 'percentage': l(), 'probability': l()}
+        inter = [{'count': {}, 'percentage': {}, 'probability': {}}
                  for _ in range(max_distance + 1)]
 
-        # Process all counts first
-        for result in results:
-            stat, value = result
+        # Process all counts first, keeping the intersections aside
+        intersections = []
+        for stat, value in results:
             if stat == 'count':
                 process_count(value, count)
+            elif stat == 'intersection':
+                intersections.append(value)
             elif stat == 'student_count':
                 student_count = value
 
         # Once counting is complete, process the intersections
-        for result in results:
-            stat, value = result
-            if stat != 'intersection':
-                continue
+        for value in intersections:
             process_intersection(value, count, inter)
 
         # Reprocess counts to eliminate non relevant information
@@ -1152,6 +1498,6 @@ class ClusterStatisticsDataSource(data_sources.AbstractSmallRestDataSource):
         # This function is long and complicated, but it is so to send the data
         # as much processed as possible to the javascript in the page.
         # The information is adjusted to fit the graphics easily.
-        results = list(jobs.MapReduceJob.get_results(clustering_generator_job))
+        results = jobs.MapReduceJob.get_results(clustering_generator_job)
         # data, page_number
         return ClusterStatisticsDataSource._process_job_result(results), 0